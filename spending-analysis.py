@@ -1,34 +1,62 @@
+import os
+from typing import Iterator
+
 import pandas as pd
 import matplotlib.pyplot as plt
 
+# Arrow-backed strings run .str.replace on pyarrow's compute kernels; plain str otherwise.
+# pyarrow also enables reading the Parquet output of transaction-classification.py.
+try:
+    import pyarrow.parquet as pq
+    STRING_DTYPE = "string[pyarrow]"
+except ImportError:
+    pq = None
+    STRING_DTYPE = str
+
 INPUT_CSV = "mastersheet_classified.csv"
+INPUT_PARQUET = "mastersheet_classified.parquet"
+
+# Only these columns are read from the input
+ANALYSIS_COLUMNS = {"Date", "Amount", "Category", "Confidence"}
+
+# How many rows to read and clean at a time
+CHUNK_SIZE = 100_000
 
 MIN_CONFIDENCE = 0.60
 EXCLUDE_CATEGORIES = {"Transfer"}  # remove if you want transfers included
 
-def load_df(path: str) -> pd.DataFrame:
-    df = pd.read_csv(path)
+# Date formats tried before falling back to pandas' per-row inference
+DATE_FORMATS = ["%Y-%m-%d", "%m/%d/%Y"]
+
+def parse_dates(s: pd.Series) -> pd.Series:
+    # An explicit format uses the fast strptime path; accept it only if it parses every value
+    expected = s.notna().sum()
+    for fmt in DATE_FORMATS:
+        parsed = pd.to_datetime(s, format=fmt, errors="coerce")
+        if parsed.notna().sum() == expected:
+            return parsed
+    return pd.to_datetime(s, errors="coerce")
 
+def clean_chunk(df: pd.DataFrame) -> pd.DataFrame:
     required = {"Date", "Amount", "Category"}
     missing = required - set(df.columns)
     if missing:
         raise ValueError(f"Missing columns: {sorted(missing)}. Found: {df.columns.tolist()}")
 
-    df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+    df["Date"] = parse_dates(df["Date"])
     df = df.dropna(subset=["Date"])
 
-    # Amount parsing (handles $, commas, parentheses)
-    amt = (
-        df["Amount"]
-        .astype(str)
-        .str.replace("$", "", regex=False)
-        .str.replace(",", "", regex=False)
-        .str.strip()
-    )
-    # Handle (123.45) as negative
-    amt = amt.str.replace("(", "-", regex=False).str.replace(")", "", regex=False)
-
-    df["Amount"] = pd.to_numeric(amt, errors="coerce")
+    # Amount parsing (handles $, commas, parentheses); already-numeric columns skip the string path
+    if not pd.api.types.is_numeric_dtype(df["Amount"]):
+        amt = (
+            df["Amount"]
+            .astype(STRING_DTYPE)
+            .str.replace(r"[\$,\s\)]", "", regex=True)
+            # Handle (123.45) as negative
+            .str.replace("(", "-", regex=False)
+        )
+        # Arrow strings convert to nullable Float64/Int64; keep Amount plain float64 either way
+        df["Amount"] = pd.to_numeric(amt, errors="coerce").astype("float64")
     df = df.dropna(subset=["Amount"])
 
     # Confidence filter if present
@@ -36,10 +64,36 @@ def load_df(path: str) -> pd.DataFrame:
         df["Confidence"] = pd.to_numeric(df["Confidence"], errors="coerce")
         df = df[df["Confidence"].fillna(0) >= MIN_CONFIDENCE]
 
-    df["Category"] = df["Category"].astype(str).str.strip()
+    df["Category"] = df["Category"].fillna("").astype(str).str.strip()
     df.loc[df["Category"].eq("") | df["Category"].eq("nan"), "Category"] = "Misc"
 
-    df["Month"] = df["Date"].dt.to_period("M").dt.to_timestamp()
+    return df
+
+def read_chunks(path: str) -> Iterator[pd.DataFrame]:
+    if path.endswith(".parquet"):
+        pf = pq.ParquetFile(path)
+        columns = [c for c in pf.schema_arrow.names if c in ANALYSIS_COLUMNS]
+        empty = True
+        for batch in pf.iter_batches(batch_size=CHUNK_SIZE, columns=columns):
+            empty = False
+            yield batch.to_pandas()
+        # A file with no rows yields no batches; give load_df one empty frame to concat
+        if empty:
+            yield pf.schema_arrow.empty_table().select(columns).to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=CHUNK_SIZE, usecols=lambda c: c in ANALYSIS_COLUMNS)
+
+def load_df(path: str) -> pd.DataFrame:
+    # Clean the input chunk by chunk so only kept rows are held in memory at once
+    chunks = [clean_chunk(chunk) for chunk in read_chunks(path)]
+    df = pd.concat(chunks, ignore_index=True)
+
+    # Categorical codes make the Category groupbys hash ints instead of strings.
+    # Converted after concat so every chunk shares the same categories.
+    df["Category"] = df["Category"].astype("category")
+
+    # Truncate to month start with a numpy dtype cast rather than a Period round-trip
+    df["Month"] = df["Date"].to_numpy().astype("datetime64[M]").astype("datetime64[ns]")
 
     # Since your file is spending-only, treat magnitude as spend
     df["Spend"] = df["Amount"].abs()
@@ -49,9 +103,9 @@ def load_df(path: str) -> pd.DataFrame:
 
     return df
 
-def quick_stats(df: pd.DataFrame) -> None:
-    total_spend = df["Spend"].sum()
-    months = df["Month"].nunique()
+def quick_stats(df: pd.DataFrame, spend_by_cat: pd.Series, monthly: pd.Series) -> None:
+    total_spend = spend_by_cat.sum()
+    months = len(monthly)
     rows = len(df)
 
     print("Summary")
@@ -61,21 +115,11 @@ def quick_stats(df: pd.DataFrame) -> None:
     if months > 0:
         print(f"Avg monthly spending: {(total_spend / months):,.2f}")
 
-    top = (
-        df.groupby("Category")["Spend"]
-        .sum()
-        .sort_values(ascending=False)
-    )
     print("\nTop spending categories")
-    print(top.head(12).to_string())
+    print(spend_by_cat.head(12).to_string())
 
-def chart_spend_by_category(df: pd.DataFrame) -> None:
-    spend = (
-        df.groupby("Category")["Spend"]
-        .sum()
-        .sort_values(ascending=False)
-    )
-    spend = spend[spend > 0]
+def chart_spend_by_category(spend_by_cat: pd.Series) -> None:
+    spend = spend_by_cat[spend_by_cat > 0]
 
     if spend.empty:
         print("No spend data to plot in chart_spend_by_category.")
@@ -90,9 +134,7 @@ def chart_spend_by_category(df: pd.DataFrame) -> None:
     plt.savefig("chart_spend_by_category.png", dpi=160)
     plt.close()
 
-def chart_monthly_spend(df: pd.DataFrame) -> None:
-    monthly = df.groupby("Month")["Spend"].sum().sort_index()
-
+def chart_monthly_spend(monthly: pd.Series) -> None:
     if monthly.empty:
         print("No spend data to plot in chart_monthly_spend.")
         return
@@ -106,13 +148,8 @@ def chart_monthly_spend(df: pd.DataFrame) -> None:
     plt.savefig("chart_monthly_spend.png", dpi=160)
     plt.close()
 
-def chart_category_share_pie(df: pd.DataFrame) -> None:
-    spend = (
-        df.groupby("Category")["Spend"]
-        .sum()
-        .sort_values(ascending=False)
-    )
-    spend = spend[spend > 0]
+def chart_category_share_pie(spend_by_cat: pd.Series) -> None:
+    spend = spend_by_cat[spend_by_cat > 0]
 
     if spend.empty:
         print("No spend data to plot in chart_category_share_pie.")
@@ -132,8 +169,7 @@ def chart_category_share_pie(df: pd.DataFrame) -> None:
     plt.savefig("chart_category_share.png", dpi=160)
     plt.close()
 
-def month_over_month(df: pd.DataFrame) -> None:
-    monthly = df.groupby("Month")["Spend"].sum().sort_index()
+def month_over_month(monthly: pd.Series) -> None:
     if len(monthly) < 2:
         return
 
@@ -148,36 +184,59 @@ def month_over_month(df: pd.DataFrame) -> None:
     else:
         print(f"Last month spending change: {delta:,.2f} ({pct:.1f}%)")
 
-def largest_swings(df: pd.DataFrame) -> None:
+def largest_swings(df: pd.DataFrame, monthly: pd.Series) -> None:
     # Compare last month vs average of prior months for each category
-    if df["Month"].nunique() < 3:
+    if len(monthly) < 3:
         return
 
-    last_month = df["Month"].max()
-    prior = df[df["Month"] < last_month]
-    last_df = df[df["Month"] == last_month]
-
-    prior_avg = prior.groupby("Category")["Spend"].sum() / prior["Month"].nunique()
-    last_sum = last_df.groupby("Category")["Spend"].sum()
+    # One Category x Month table; months with no spend in a category count as 0
+    pivot = (
+        df.groupby(["Category", "Month"], observed=True)["Spend"]
+        .sum()
+        .unstack(fill_value=0)
+    )
+    last_month = pivot.columns.max()
+    last_sum = pivot[last_month]
+    prior_avg = pivot.drop(columns=last_month).mean(axis=1)
 
     swing = (last_sum - prior_avg).sort_values(ascending=False)
 
     print("\nLargest category overspends vs prior-month average (top 10)")
     print(swing.head(10).to_string())
 
+def pick_input() -> str:
+    # Both formats can exist after pyarrow is installed or removed; read the newer one
+    existing = [p for p in (INPUT_CSV, INPUT_PARQUET) if os.path.exists(p)]
+    if not existing:
+        return INPUT_CSV
+    newest = max(existing, key=os.path.getmtime)
+    if newest == INPUT_PARQUET and pq is None:
+        print(f"Warning: {INPUT_PARQUET} is newer but pyarrow is not installed; reading {INPUT_CSV}")
+        return INPUT_CSV
+    return newest
+
 def main():
-    df = load_df(INPUT_CSV)
+    path = pick_input()
+    print(f"Reading {path}")
+    df = load_df(path)
 
     if EXCLUDE_CATEGORIES:
-        df = df[~df["Category"].isin(EXCLUDE_CATEGORIES)].copy()
+        # Compare integer category codes rather than the category strings
+        categories = df["Category"].cat.categories
+        excluded_codes = [categories.get_loc(c) for c in EXCLUDE_CATEGORIES if c in categories]
+        df = df[~df["Category"].cat.codes.isin(excluded_codes)].copy()
+
+    # Shared aggregates, computed once and reused by the stats and charts below
+    spend_by_cat = df.groupby("Category", observed=True)["Spend"].sum().sort_values(ascending=False)
+    monthly = df.groupby("Month")["Spend"].sum().sort_index()
 
-    quick_stats(df)
-    month_over_month(df)
-    largest_swings(df)
+    quick_stats(df, spend_by_cat, monthly)
+    month_over_month(monthly)
+    largest_swings(df, monthly)
 
-    chart_spend_by_category(df)
-    chart_monthly_spend(df)
-    chart_category_share_pie(df)
+    chart_spend_by_category(spend_by_cat)
+    chart_monthly_spend(monthly)
+    chart_category_share_pie(spend_by_cat)
 
     print("\nSaved charts:")
     print("chart_spend_by_category.png")
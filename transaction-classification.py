@@ -1,11 +1,13 @@
 import os
 import json
-import time
-import hashlib
-from typing import Dict, Any, List, Tuple
+import codecs
+import asyncio
+import itertools
+from typing import Dict, Any, BinaryIO, Iterator, List, Tuple
 
+import numpy as np
 import pandas as pd
-from openai import OpenAI
+from openai import AsyncOpenAI, RateLimitError
 
 # Load environment variables from .env if python-dotenv is installed
 try:
@@ -14,22 +16,50 @@ try:
 except Exception:
     pass
 
+# Use orjson for cache and response (de)serialization if installed; stdlib json otherwise
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    json_loads = json.loads
+
+# Write the classified output as Parquet if pyarrow is installed; CSV otherwise
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # Read API key from environment (support multiple common names)
 from os import getenv
 API_KEY = getenv("API_KEY") or getenv("OPENAI_API_KEY") or getenv("API_TOKEN")
 
 INPUT_CSV = "mastersheet.csv"
 OUTPUT_CSV = "mastersheet_classified.csv"
-CACHE_FILE = "classification_cache.json"
+OUTPUT_PARQUET = "mastersheet_classified.parquet"
+CACHE_FILE = "classification_cache.jsonl"
 
 MODEL = "gpt-5-mini"
 
+# How many CSV rows to read and classify at a time
+CHUNK_SIZE = 100_000
+
 # How many rows per API call
 BATCH_SIZE = 30
 
 # Retry settings
 MAX_RETRIES = 5
 
+# How many API calls may be in flight at once (one per worker)
+MAX_CONCURRENCY = 8
+
 CATEGORIES = [
     "Income",
     "Transfer",
@@ -47,6 +77,33 @@ CATEGORIES = [
     "Misc",
 ]
 
+# Structured output schema; strict mode makes the API return JSON that matches it exactly
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "name": "classification",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "row_id": {"type": "integer"},
+                        "category": {"type": "string", "enum": CATEGORIES},
+                        "confidence": {"type": "number"},
+                    },
+                    "required": ["row_id", "category", "confidence"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["items"],
+        "additionalProperties": False,
+    },
+}
+
 SYSTEM_PROMPT = f"""
 You classify bank transactions using only Description and Amount.
 
@@ -73,84 +130,116 @@ Notes:
 - If positive amount and payroll-like, use "Income".
 """
 
-def hash_key(description: str, amount: str) -> str:
-    raw = f"{description}|{amount}".strip().lower()
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
-
-def load_cache() -> Dict[str, Any]:
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
-def save_cache(cache: Dict[str, Any]) -> None:
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
-
-def chunk_rows(rows: List[Tuple[int, str, str]], batch_size: int) -> List[List[Tuple[int, str, str]]]:
-    return [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
-
-def parse_json_output(text: str) -> Dict[str, Any]:
-    t = text.strip()
-
-    # Remove code fences if present
-    if t.startswith("```"):
-        t = t.replace("```json", "").replace("```", "").strip()
-
-    # If model accidentally added leading/trailing text, try to extract JSON object
-    first = t.find("{")
-    last = t.rfind("}")
-    if first != -1 and last != -1 and last > first:
-        t = t[first:last + 1]
+CacheKey = Tuple[str, str]
 
-    return json.loads(t)
+def cache_key(description: str, amount: str) -> CacheKey:
+    return (description.strip().lower(), amount.strip().lower())
 
-def classify_batch(client: OpenAI, batch: List[Tuple[int, str, str]]) -> List[Dict[str, Any]]:
+def load_cache() -> Dict[CacheKey, Any]:
+    # One JSON record per line; later lines win if a key was written more than once
+    cache: Dict[CacheKey, Any] = {}
+    if os.path.exists(CACHE_FILE):
+        with open(CACHE_FILE, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                # An interrupted append can leave a torn or partial record; skip it
+                try:
+                    rec = json_loads(line)
+                    cache[tuple(rec["key"])] = rec["value"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return cache
+
+def open_cache_for_append() -> BinaryIO:
+    f = open(CACHE_FILE, "ab")
+    # A torn last record has no trailing newline; start new records on a fresh line
+    if os.path.getsize(CACHE_FILE) > 0:
+        with open(CACHE_FILE, "rb") as r:
+            r.seek(-1, os.SEEK_END)
+            if r.read(1) != b"\n":
+                f.write(b"\n")
+    return f
+
+def append_cache(f: BinaryIO, entries: Dict[CacheKey, Any]) -> None:
+    f.write(b"".join(json_dumps({"key": list(k), "value": v}) + b"\n" for k, v in entries.items()))
+    f.flush()
+
+def chunk_rows(rows: List[Tuple[int, str, str]], batch_size: int) -> Iterator[List[Tuple[int, str, str]]]:
+    it = iter(rows)
+    return iter(lambda: list(itertools.islice(it, batch_size)), [])
+
+def retry_delay(err: Exception, attempt: int) -> float:
+    # On a 429, wait as long as the API asks rather than the full exponential backoff
+    if isinstance(err, RateLimitError):
+        headers = err.response.headers
+        for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            try:
+                return float(headers[name]) * scale
+            except (KeyError, ValueError):
+                continue
+    return 2 ** attempt
+
+async def classify_batch(
+    client: AsyncOpenAI, batch: List[Tuple[int, str, str]]
+) -> List[Dict[str, Any]]:
     payload = {
         "rows": [{"row_id": rid, "description": desc, "amount": amt} for (rid, desc, amt) in batch]
     }
 
     for attempt in range(MAX_RETRIES):
         try:
-            r = client.responses.create(
+            r = await client.responses.create(
                 model=MODEL,
                 input=[
                     {"role": "developer", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
-                ]
+                ],
+                text={"format": RESPONSE_FORMAT},
             )
-            data = parse_json_output(r.output_text)
+            # The schema guarantees bare, schema-valid JSON, so no fence stripping is needed
+            data = json_loads(r.output_text)
             items = data.get("items", [])
             return items
-        except Exception:
+        except Exception as e:
             if attempt == MAX_RETRIES - 1:
                 raise
-            time.sleep(2 ** attempt)
-
-def read_csv_robust(path: str) -> pd.DataFrame:
-    # Try a few common encodings; fallback uses latin1 with replace via open()
-    encodings_to_try = ["utf-8-sig", "utf-16", "utf-16-le", "cp1252", "latin1"]
-    last_err = None
-    for enc in encodings_to_try:
+            await asyncio.sleep(retry_delay(e, attempt))
+
+def detect_encoding(path: str) -> str:
+    # A BOM settles it; otherwise stream-decode the raw bytes, which is far cheaper than a CSV parse
+    with open(path, "rb") as f:
+        head = f.read(4)
+    if head.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
+    if head.startswith(b"\xff\xfe") or head.startswith(b"\xfe\xff"):
+        return "utf-16"
+
+    for enc in ("utf-8", "cp1252"):
+        decoder = codecs.getincrementaldecoder(enc)()
         try:
-            return pd.read_csv(path, encoding=enc)
-        except Exception as e:
-            last_err = e
-
-    # Final fallback: decode anything and replace bad characters (works on old pandas)
-    with open(path, "r", encoding="latin1", errors="replace", newline="") as f:
-        return pd.read_csv(f)
-
-def main():
-    if not API_KEY:
-        raise RuntimeError(
-            "API key not found. Set API_KEY (or OPENAI_API_KEY/API_TOKEN) in your environment or .env file."
-        )
-
-    client = OpenAI(api_key=API_KEY)
-
-    df = read_csv_robust(INPUT_CSV)
-
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    decoder.decode(block)
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            continue
+        return enc
+
+    # latin1 maps every byte, so it always decodes
+    return "latin1"
+
+def read_csv_robust(path: str, chunksize: int) -> Iterator[pd.DataFrame]:
+    # Read every column as text: per-chunk type inference would turn 15 into "15.0" in some
+    # chunks and not others, splitting cache keys and rewriting values in the output
+    return pd.read_csv(path, encoding=detect_encoding(path), chunksize=chunksize, dtype=str)
+
+async def classify_chunk(
+    client: AsyncOpenAI,
+    cache: Dict[CacheKey, Any],
+    cache_f: BinaryIO,
+    df: pd.DataFrame,
+) -> None:
     required = {"Description", "Amount"}
     if not required.issubset(set(df.columns)):
         raise ValueError(f"CSV must include columns: {sorted(required)}. Found: {df.columns.tolist()}")
@@ -160,56 +249,144 @@ def main():
     if "Confidence" not in df.columns:
         df["Confidence"] = None
 
-    cache = load_cache()
-
     # Prepare rows needing classification
-    to_classify: List[Tuple[int, str, str]] = []
-    for idx, row in df.iterrows():
-        desc = "" if pd.isna(row["Description"]) else str(row["Description"])
-        amt = "" if pd.isna(row["Amount"]) else str(row["Amount"])
-        k = hash_key(desc, amt)
-
-        if k in cache:
-            df.at[idx, "Category"] = cache[k]["category"]
-            df.at[idx, "Confidence"] = cache[k]["confidence"]
-        else:
-            to_classify.append((int(idx), desc, amt))
+    descs = df["Description"].fillna("").astype(str).to_numpy()
+    amts = df["Amount"].fillna("").astype(str).to_numpy()
+    hits = [cache.get(cache_key(d, a)) for d, a in zip(descs, amts)]
+    cached = np.array([h is not None for h in hits], dtype=bool)
+
+    cats = df["Category"].to_numpy(dtype=object, copy=True)
+    confs = df["Confidence"].to_numpy(dtype=object, copy=True)
+    cats[cached] = [h["category"] for h in hits if h is not None]
+    confs[cached] = [h["confidence"] for h in hits if h is not None]
+    df["Category"] = cats
+    df["Confidence"] = confs
+
+    # Chunks keep their offset in the file, so row ids are index labels, not positions
+    missing = ~cached
+    to_classify: List[Tuple[int, str, str]] = list(
+        zip(df.index[missing].tolist(), descs[missing].tolist(), amts[missing].tolist())
+    )
 
     print(f"Rows total: {len(df)}")
     print(f"Rows cached: {len(df) - len(to_classify)}")
     print(f"Rows to classify: {len(to_classify)}")
     if len(to_classify) == 0:
-        df.to_csv(OUTPUT_CSV, index=False)
-        print(f"Saved {OUTPUT_CSV}")
         return
 
-    batches = chunk_rows(to_classify, BATCH_SIZE)
-
-    for bi, batch in enumerate(batches, start=1):
-        items = classify_batch(client, batch)
-
-        # Defensive: if model returns fewer items than requested, only apply what we got
-        by_row_id = {it["row_id"]: it for it in items if "row_id" in it}
-
-        for (rid, desc, amt) in batch:
-            it = by_row_id.get(rid)
-            if not it:
-                # If missing, mark as Misc with low confidence
-                it = {"row_id": rid, "category": "Misc", "confidence": 0.2}
-
-            k = hash_key(desc, amt)
-            cache[k] = {"category": it["category"], "confidence": it["confidence"]}
-
-            df.at[rid, "Category"] = it["category"]
-            df.at[rid, "Confidence"] = it["confidence"]
+    # Identical (description, amount) pairs are sent once; the result fans out to every row
+    unique: Dict[CacheKey, Tuple[str, str, List[int]]] = {}
+    for (rid, desc, amt) in to_classify:
+        unique.setdefault(cache_key(desc, amt), (desc, amt, []))[2].append(rid)
+    print(f"Unique rows to classify: {len(unique)}")
+
+    representatives = [(rids[0], desc, amt) for (desc, amt, rids) in unique.values()]
+    n_batches = -(-len(representatives) // BATCH_SIZE)
+
+    all_rids: List[int] = []
+    all_cats: List[str] = []
+    all_confs: List[float] = []
+
+    # A fixed pool of workers pulls batches lazily from chunk_rows, so only the batches in
+    # flight exist at once. Results come back through a queue and are applied here, keeping
+    # cache writes on a single coroutine. Only new entries are appended to the cache file.
+    batches = chunk_rows(representatives, BATCH_SIZE)
+    results: asyncio.Queue = asyncio.Queue()
+
+    async def worker() -> None:
+        for batch in batches:
+            try:
+                items = await classify_batch(client, batch)
+            except Exception as e:
+                await results.put(e)
+                return
+            await results.put((batch, items))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(MAX_CONCURRENCY, n_batches))]
+    try:
+        for bi in range(1, n_batches + 1):
+            result = await results.get()
+            if isinstance(result, Exception):
+                raise result
+            batch, items = result
+
+            # Defensive: if model returns fewer items than requested, only apply what we got
+            by_row_id = {it["row_id"]: it for it in items if "row_id" in it}
+
+            new_entries: Dict[CacheKey, Any] = {}
+            for (rid, desc, amt) in batch:
+                it = by_row_id.get(rid)
+                if not it:
+                    # If missing, mark as Misc with low confidence
+                    it = {"row_id": rid, "category": "Misc", "confidence": 0.2}
+
+                k = cache_key(desc, amt)
+                new_entries[k] = {"category": it["category"], "confidence": it["confidence"]}
+
+                rids = unique[k][2]
+                all_rids.extend(rids)
+                all_cats.extend([it["category"]] * len(rids))
+                all_confs.extend([it["confidence"]] * len(rids))
+
+            cache.update(new_entries)
+            append_cache(cache_f, new_entries)
+            print(f"Batch {bi}/{n_batches} complete")
+    finally:
+        for w in workers:
+            w.cancel()
+
+    # Apply all results in one vectorized assignment rather than per-row setters
+    df.loc[all_rids, "Category"] = all_cats
+    df.loc[all_rids, "Confidence"] = all_confs
+
+def to_arrow_table(df: pd.DataFrame) -> "pa.Table":
+    # Input columns are already text; the string dtype still pins a column that is entirely
+    # blank in one chunk to a string type, so every chunk shares the same Parquet schema
+    out = df.astype("string")
+    out["Confidence"] = pd.to_numeric(df["Confidence"], errors="coerce").astype("float64")
+    return pa.Table.from_pandas(out, preserve_index=False)
+
+async def main():
+    if not API_KEY:
+        raise RuntimeError(
+            "API key not found. Set API_KEY (or OPENAI_API_KEY/API_TOKEN) in your environment or .env file."
+        )
 
-        save_cache(cache)
-        print(f"Batch {bi}/{len(batches)} complete")
+    cache = load_cache()
 
-    df.to_csv(OUTPUT_CSV, index=False)
-    print(f"Saved {OUTPUT_CSV}")
+    # Stream the input in chunks so peak memory is bounded by one chunk; each classified
+    # chunk is appended to the output, and the cache carries over to later chunks.
+    # Chunks go to a temp file that replaces the output only after every chunk succeeds,
+    # so a failed run leaves the previous complete output in place
+    output = OUTPUT_CSV if pq is None else OUTPUT_PARQUET
+    tmp = output + ".tmp"
+    writer = None
+    try:
+        async with AsyncOpenAI(api_key=API_KEY) as client:
+            with open_cache_for_append() as cache_f:
+                for i, df in enumerate(read_csv_robust(INPUT_CSV, CHUNK_SIZE)):
+                    print(f"Chunk {i + 1}")
+                    await classify_chunk(client, cache, cache_f, df)
+
+                    if pq is None:
+                        df.to_csv(tmp, mode="w" if i == 0 else "a", header=(i == 0), index=False)
+                        continue
+                    table = to_arrow_table(df)
+                    if writer is None:
+                        writer = pq.ParquetWriter(tmp, table.schema, compression="zstd")
+                    writer.write_table(table)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    if writer is not None:
+        writer.close()
+    if os.path.exists(tmp):
+        os.replace(tmp, output)
+    print(f"Saved {output}")
 
 if __name__ == "__main__":
-    main()
-
-
+    asyncio.run(main())